@@ -1,28 +1,57 @@
-from fastapi import FastAPI, UploadFile, File, Query, HTTPException, Depends
-from fastapi.responses import StreamingResponse, JSONResponse, HTMLResponse
+from fastapi import FastAPI, UploadFile, File, Query, HTTPException, Depends, BackgroundTasks
+from fastapi.responses import Response, StreamingResponse, JSONResponse, HTMLResponse
 from ultralytics import YOLO
+import torch
 from prometheus_fastapi_instrumentator import Instrumentator
 from pydantic_settings import BaseSettings
 from cap_from_youtube import cap_from_youtube
 import cv2
 import numpy as np
-import io
+import asyncio
 import sqlite3
 import os
 import time
+import threading
+import queue
+import logging
+import shutil
+import tempfile
 from datetime import datetime
+from PIL import Image
 from collections import Counter
 from functools import lru_cache
 
+# libjpeg-turbo (SIMD) encoder; falls back to cv2.imencode if the native lib is missing
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+    jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    # RuntimeError: PyTurboJPEG is installed but cannot locate libturbojpeg
+    jpeg = None
+
 # --- 1. CONFIGURATION ---
 class Settings(BaseSettings):
     app_name: str = "YOLOv8 MLOps Service"
     model_path: str = "yolov8n.pt"
     db_path: str = "data/detections.db"
     max_log_entries: int = 1000
+    # Rotate logs once this many rows were inserted since the last cleanup
+    cleanup_interval: int = 100
     video_source: str = "https://github.com/intel-iot-devkit/sample-videos/raw/master/people-detection.mp4"
+    # Frames per YOLO call in the live stream (amortizes per-call overhead)
+    stream_batch_size: int = 8
+    # Prefer a TensorRT engine on CUDA hosts (exported next to model_path on first start)
+    use_tensorrt: bool = True
+    imgsz: int = 640
+    trt_max_batch: int = 16
+    jpeg_quality: int = 80
+    # Micro-batching of concurrent /detect_* requests
+    infer_batch_size: int = 8
+    infer_max_wait_ms: int = 10
     # Link to your code (Great for Portfolio)
     github_url: str = "https://github.com/Western-1" 
+    # Uvicorn worker processes; 0 = auto (1 per GPU model, up to 4 for CPU inference)
+    workers: int = 0
 
     class Config:
         env_file = ".env"
@@ -32,18 +61,96 @@ def get_settings():
     return Settings()
 
 settings = get_settings()
+logger = logging.getLogger(__name__)
 app = FastAPI(title=settings.app_name)
 
 # --- 2. OBSERVABILITY ---
 Instrumentator().instrument(app).expose(app)
-model = YOLO(settings.model_path)
+
+# --- MODEL ---
+# FP16 only pays off on CUDA (Tensor Cores); CPU inference stays FP32
+device = "cuda" if torch.cuda.is_available() else "cpu"
+half = device == "cuda"
+
+def load_model():
+    """TensorRT engine on CUDA (built once from the .pt weights), PyTorch otherwise."""
+    if device == "cuda" and settings.use_tensorrt:
+        # Max batch must cover both request flushes and stream batches
+        batch = max(settings.trt_max_batch, settings.stream_batch_size, settings.infer_batch_size)
+        # Build parameters are part of the file name, so a stale engine is never reused
+        engine_path = f"{os.path.splitext(settings.model_path)[0]}_b{batch}_{settings.imgsz}.engine"
+        try:
+            if not os.path.exists(engine_path):
+                weights = YOLO(settings.model_path).ckpt_path
+                # Export from a private copy: ultralytics writes its .onnx/.engine next to the
+                # weights, so concurrent workers would otherwise clobber each other's files
+                with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(engine_path))) as tmp:
+                    # Dynamic shapes: single uploads and stream batches share one engine
+                    exported = YOLO(shutil.copy(weights, tmp)).export(
+                        format="engine", half=True, dynamic=True, batch=batch,
+                        imgsz=settings.imgsz, workspace=4
+                    )
+                    os.replace(exported, engine_path)
+            return YOLO(engine_path, task="detect")
+        except Exception as e:
+            logger.warning("TensorRT unavailable (%s), falling back to PyTorch", e)
+
+    model = YOLO(settings.model_path)
+    model.to(device)
+    if half:
+        model.model.half()
+    return model
+
+# Loaded per worker in the startup hook, never in the uvicorn supervisor process
+model = None
+# Class id -> name as a tuple: plain index in the per-box loops, no dict hashing
+NAMES = ()
+
+def worker_count():
+    """Workers to launch from `python main.py`: WORKERS, or 1 per GPU model / up to 4 for CPU inference."""
+    return settings.workers or (1 if device == "cuda" else min(4, os.cpu_count() or 1))
+
+def serving_workers():
+    """Worker processes actually running: WEB_CONCURRENCY, which main.py exports and uvicorn
+    also reads as its --workers default. Plain `uvicorn main:app` runs a single worker."""
+    return max(1, int(os.environ.get("WEB_CONCURRENCY") or 1))
+
+# The ultralytics predictor (and a TensorRT execution context) keeps per-call state,
+# so the batcher and every stream's inference thread take turns on the one model
+model_lock = threading.Lock()
+
+def predict(source, conf):
+    """Plain inference: no console logging, saving or display in the ultralytics predictor."""
+    with model_lock:
+        return model.predict(
+            source, conf=conf, imgsz=settings.imgsz, half=half, device=device,
+            verbose=False, save=False, show=False, stream=False
+        )
 
 # --- 3. DATABASE LAYER ---
+# One long-lived connection per thread: no per-call connect, PRAGMAs applied once per connection
+_tls = threading.local()
+cleanup_lock = threading.Lock()
+rows_since_cleanup = 0
+
+def get_conn():
+    conn = getattr(_tls, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(settings.db_path)
+        conn.row_factory = sqlite3.Row
+        # WAL lets /history read while detections are being written
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=134217728")
+        _tls.conn = conn
+    return conn
+
 def init_db():
     os.makedirs(os.path.dirname(settings.db_path), exist_ok=True)
-    with sqlite3.connect(settings.db_path) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
+    conn = get_conn()
+    with conn:
+        conn.execute('''
             CREATE TABLE IF NOT EXISTS logs (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 timestamp TEXT,
@@ -52,81 +159,430 @@ def init_db():
                 confidence REAL
             )
         ''')
-        conn.commit()
 
 def cleanup_old_logs():
-    with sqlite3.connect(settings.db_path) as conn:
-        cursor = conn.cursor()
-        cursor.execute(f'''
-            DELETE FROM logs 
-            WHERE id NOT IN (
-                SELECT id FROM logs ORDER BY id DESC LIMIT {settings.max_log_entries}
-            )
-        ''')
-        conn.commit()
+    # Range delete on the rowid btree instead of materializing a NOT IN set
+    conn = get_conn()
+    with conn:
+        conn.execute('''
+            DELETE FROM logs
+            WHERE id < (SELECT MIN(id) FROM (SELECT id FROM logs ORDER BY id DESC LIMIT ?))
+        ''', (settings.max_log_entries,))
+
+def detected_objects(result):
+    """(class names, confidences) for one result; two device->host copies instead of two per box."""
+    boxes = result.boxes
+    cls_ids = boxes.cls.cpu().numpy().astype(np.int32).tolist()
+    confs = boxes.conf.cpu().numpy().tolist()
+    return [NAMES[i] for i in cls_ids], confs
 
-def log_detection(filename, results):
+def log_detection(filename, names, confs, background_tasks):
     """Only logs uploaded images to DB, NOT video stream."""
+    global rows_since_cleanup
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with sqlite3.connect(settings.db_path) as conn:
-        cursor = conn.cursor()
-        has_detections = False
-        for box in results[0].boxes:
-            cursor.execute(
-                "INSERT INTO logs (timestamp, filename, object_class, confidence) VALUES (?, ?, ?, ?)",
-                (timestamp, filename, model.names[int(box.cls)], float(box.conf))
-            )
-            has_detections = True
-        conn.commit()
-    if has_detections:
-        cleanup_old_logs()
-
-init_db()
+    rows = [(timestamp, filename, name, conf) for name, conf in zip(names, confs)]
+    if not rows:
+        return
+    conn = get_conn()
+    with conn:
+        conn.executemany(
+            "INSERT INTO logs (timestamp, filename, object_class, confidence) VALUES (?, ?, ?, ?)", rows
+        )
+    with cleanup_lock:
+        rows_since_cleanup += len(rows)
+        due = rows_since_cleanup >= settings.cleanup_interval
+        if due:
+            rows_since_cleanup = 0
+    # Rotation runs after the response is sent
+    if due:
+        background_tasks.add_task(cleanup_old_logs)
 
 # --- 4. IMAGE & VIDEO PROCESSING ---
-def process_image(contents):
+async def read_upload(file: UploadFile):
+    """Copies the spooled upload straight into one preallocated buffer, off the event loop."""
+    if file.size is None:
+        return await file.read()
+    buf = bytearray(file.size)
+    await file.seek(0)
+    n = await asyncio.to_thread(file.file.readinto, buf)
+    return memoryview(buf)[:n]
+
+def encode_jpeg(img):
+    """BGR ndarray -> JPEG bytes."""
+    if jpeg is not None:
+        return jpeg.encode(img, quality=settings.jpeg_quality, pixel_format=TJPF_BGR)
+    ret, buffer = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, settings.jpeg_quality])
+    return buffer.tobytes()
+
+REDUCED_DECODE_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+def reduced_decode_flag(fp, target_size):
+    """Largest JPEG DCT-domain downscale that keeps the long side >= target_size.
+
+    Only for paths that never return pixels (YOLO resizes to target_size anyway).
+    PIL parses just the header straight from the spooled upload, without copying the body.
+    """
+    try:
+        with Image.open(fp) as im:
+            fmt, (w, h) = im.format, im.size
+    except Exception:
+        return cv2.IMREAD_COLOR
+    finally:
+        fp.seek(0)
+    if fmt != "JPEG":
+        return cv2.IMREAD_COLOR
+    for factor, flag in REDUCED_DECODE_FLAGS:
+        if max(w, h) // factor >= target_size:
+            return flag
+    return cv2.IMREAD_COLOR
+
+def process_image(contents, flag=cv2.IMREAD_COLOR):
     nparr = np.frombuffer(contents, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    img = cv2.imdecode(nparr, flag)
     return img
 
-def generate_frames(source, conf_threshold):
+async def process_image_async(contents, flag=cv2.IMREAD_COLOR):
+    """imdecode releases the GIL, so concurrent uploads decode in parallel in the threadpool."""
+    return await asyncio.to_thread(process_image, contents, flag)
+
+class Batcher:
+    """Coalesces images from concurrent requests into one model call per flush."""
+
+    def __init__(self, max_batch=8, max_wait_ms=10):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def submit(self, img, conf):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((img, conf, future))
+        return await future
+
+    async def _collect(self):
+        """Blocks for the first item, then takes whatever arrives within max_wait."""
+        loop = asyncio.get_running_loop()
+        items = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(items) < self.max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return items
+
+    async def _run(self):
+        while True:
+            items = []
+            for item in await self._collect():
+                # An undecodable upload must not fail the valid requests batched with it
+                if item[0] is None:
+                    if not item[2].done():
+                        item[2].set_exception(ValueError("image could not be decoded"))
+                else:
+                    items.append(item)
+            # model() takes a single threshold, so flush one call per distinct conf
+            groups = {}
+            for item in items:
+                groups.setdefault(item[1], []).append(item)
+            for conf, group in groups.items():
+                try:
+                    results = await asyncio.to_thread(predict, [img for img, _, _ in group], conf)
+                except Exception as e:
+                    for _, _, future in group:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (_, _, future), result in zip(group, results):
+                    # Client may have disconnected and cancelled its future
+                    if not future.done():
+                        future.set_result(result)
+
+batcher = Batcher(settings.infer_batch_size, settings.infer_max_wait_ms)
+
+@app.on_event("startup")
+def load_resources():
+    """Per-worker setup: model, class names and the DB schema."""
+    global model, NAMES
+    if device == "cpu":
+        # Split the cores between workers instead of every worker's torch using all of them
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // serving_workers()))
+    model = load_model()
+    NAMES = tuple(model.names[i] for i in range(len(model.names)))
+    init_db()
+
+def probe_source_frame(source):
+    """One frame from the stream source, so warmup sees its real letterbox shape."""
+    cap = open_capture(source)
+    if cap is None:
+        return None
+    try:
+        success, frame = cap.read()
+        return frame if success else None
+    finally:
+        cap.release()
+
+@app.on_event("startup")
+def warmup():
+    """Pays CUDA context init, cuDNN autotuning and lazy setup before the first real request."""
+    dummy = np.zeros((settings.imgsz, settings.imgsz, 3), dtype=np.uint8)
+    for _ in range(3):
+        predict(dummy, conf=0.25)
+    # Autotune the stream's batch shape on the same path the stream uses
+    frame = probe_source_frame(settings.video_source)
+    if frame is None:
+        logger.warning("Video source unavailable at startup; stream warmup skipped")
+        return
+    frames = [frame] * settings.stream_batch_size
+    predict_staged(FrameStager(settings.stream_batch_size).stage(frames), frames, 0.25)
+
+@app.on_event("startup")
+async def start_batcher():
+    batcher.start()
+
+def open_capture(source):
     if str(source).isdigit():
         cap = cv2.VideoCapture(int(source))
     elif "youtube.com" in source or "youtu.be" in source:
         try:
             cap = cap_from_youtube(source, '720p')
         except:
-            return
+            return None
     else:
         cap = cv2.VideoCapture(source)
-    
-    if not cap.isOpened(): return
+    # Keep only the newest frame in the driver buffer; our own queues do the buffering
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    return cap if cap.isOpened() else None
+
+def put_until_stopped(q, item, stop):
+    """Blocking put that gives up once the stream consumer has gone away."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+@lru_cache()
+def letterbox_geometry(shape, imgsz, stride):
+    """Same resize/pad as ultralytics' LetterBox(auto=True) for same-shape batches:
+    pad only up to a stride multiple (768x432 -> 640x384, not 640x640), so ops.scale_boxes inverts it."""
+    h, w = shape
+    r = min(imgsz / h, imgsz / w)
+    new_h, new_w = int(round(h * r)), int(round(w * r))
+    dh, dw = ((imgsz - new_h) % stride) / 2, ((imgsz - new_w) % stride) / 2
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    return (new_h, new_w), (top, bottom, left, right)
+
+def model_stride():
+    return int(model.predictor.model.stride) if model.predictor is not None else 32
+
+class FrameStager:
+    """Letterboxes stream batches into reusable buffers sized for the source; pad borders are painted once.
+
+    On CUDA the buffers are pinned and each batch is uploaded on a side stream from
+    the reader thread, so the DMA of batch N+1 overlaps inference of batch N.
+    Only the letterboxed uint8 batch crosses the bus, not the full-resolution frames.
+    """
+
+    def __init__(self, batch_size, slots=2):
+        self.batch_size = batch_size
+        self.pinned = device == "cuda"
+        self.buffers = [None] * slots
+        self.shapes = [None] * slots
+        self.copied = [None] * slots
+        self.slot = 0
+        self.stream = torch.cuda.Stream() if self.pinned else None
+
+    def stage(self, frames):
+        """BGR uint8 frames -> (letterboxed RGB BCHW tensor in [0, 1], ready event or None)."""
+        h, w = frames[0].shape[:2]
+        # Stream frame size is constant, so this is computed once and cached
+        (new_h, new_w), (top, bottom, left, right) = letterbox_geometry((h, w), settings.imgsz, model_stride())
+        i, self.slot = self.slot, (self.slot + 1) % len(self.buffers)
+        # The previous DMA out of this buffer must finish before it is overwritten
+        if self.copied[i] is not None:
+            self.copied[i].synchronize()
+        if self.shapes[i] != (h, w):
+            out_shape = (self.batch_size, top + new_h + bottom, left + new_w + right, 3)
+            self.buffers[i] = torch.full(out_shape, 114, dtype=torch.uint8, pin_memory=self.pinned)
+            self.shapes[i] = (h, w)
+        host = self.buffers[i]
+        for dst, frame in zip(host.numpy(), frames):
+            dst[top:top + new_h, left:left + new_w] = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+        host = host[:len(frames)]
+
+        if self.stream is None:
+            return host.permute(0, 3, 1, 2).flip(1).float() / 255, None
+        with torch.cuda.stream(self.stream):
+            batch = host.to(device, non_blocking=True)
+            self.copied[i] = torch.cuda.Event()
+            self.copied[i].record(self.stream)
+            batch = batch.permute(0, 3, 1, 2).flip(1).to(torch.float16 if half else torch.float32) / 255
+            ready = torch.cuda.Event()
+            ready.record(self.stream)
+        return batch, ready
+
+def predict_staged(staged, frames, conf_threshold):
+    """Inference on an already letterboxed batch, with boxes scaled onto the original frames.
+
+    Drives the predictor's preprocess/inference/postprocess directly: model.predict() on a
+    tensor would also copy the whole letterboxed batch back to the host as orig_img.
+    """
+    if model.predictor is None:
+        # Predictor is created lazily by the first predict(); warmup normally does this
+        return predict(frames, conf_threshold)
+    batch, ready = staged
+    with model_lock:
+        predictor = model.predictor
+        if ready is not None:
+            stream = torch.cuda.current_stream()
+            stream.wait_event(ready)
+            batch.record_stream(stream)
+        predictor.args.conf = conf_threshold
+        # construct_results() reads image paths from the current batch
+        predictor.batch = ([""] * len(frames), frames, [""] * len(frames))
+        # A stream's batches always share one letterbox shape, so cuDNN autotuning is paid
+        # once per shape (full batch + ragged tail). Uploads vary in batch size and letterbox
+        # shape and keep benchmark off, so no live request triggers a new autotune.
+        with torch.inference_mode(), torch.backends.cudnn.flags(enabled=True, benchmark=True):
+            im = predictor.preprocess(batch)
+            preds = predictor.inference(im)
+            # A list of orig_imgs skips convert_torch2numpy_batch and scales boxes onto the frames
+            return predictor.postprocess(preds, im, list(frames))
+
+def read_frames(cap, source, batch_q, stop):
+    """Stage 1: decode and preprocess frames into batches; bounded batch_q provides back-pressure."""
+    stager = FrameStager(settings.stream_batch_size)
+
+    def emit(frames):
+        return put_until_stopped(batch_q, (frames, stager.stage(frames)), stop)
+
+    frames = []
+    try:
+        while cap.isOpened() and not stop.is_set():
+            success, frame = cap.read()
+            if not success:
+                if "youtube" not in source and not str(source).isdigit():
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    continue
+                else: break
+            frames.append(frame)
+            if len(frames) == settings.stream_batch_size:
+                if not emit(frames):
+                    break
+                frames = []
+        # Ragged tail on EOF is flushed as a smaller batch
+        if frames and not stop.is_set():
+            emit(frames)
+    finally:
+        cap.release()
+        put_until_stopped(batch_q, None, stop)
+
+class ResultBridge:
+    """Bounded hand-off from the inference thread to the async response generator.
+
+    The producer thread blocks on a semaphore and the consumer awaits an asyncio.Queue,
+    so an open stream never parks a thread from the default executor.
+    """
+
+    def __init__(self, maxsize):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.slots = threading.Semaphore(maxsize)
+
+    def put(self, item, stop):
+        """Called from the inference thread; False once the consumer has gone away."""
+        while not self.slots.acquire(timeout=0.1):
+            if stop.is_set():
+                return False
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+        except RuntimeError:
+            # Event loop already closed (shutdown)
+            return False
+        return True
+
+    def close(self):
+        """End-of-stream marker; skips the slots so it is never dropped."""
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+        except RuntimeError:
+            pass
+
+    async def get(self):
+        item = await self.queue.get()
+        if item is not None:
+            self.slots.release()
+        return item
+
+def infer_frames(batch_q, results, stop, conf_threshold):
+    """Stage 2: one YOLO call per batch while stage 1 keeps decoding."""
+    try:
+        while not stop.is_set():
+            try:
+                item = batch_q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            frames, staged = item
+            for frame_result in predict_staged(staged, frames, conf_threshold):
+                if not results.put(frame_result, stop):
+                    return
+    finally:
+        results.close()
+
+# MJPEG part framing, built once instead of per frame
+FRAME_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+FRAME_FOOTER = b'\r\n'
+
+def render_frame(frame_result):
+    return encode_jpeg(frame_result.plot())
+
+async def generate_frames(source, conf_threshold):
+    """Stage 3: plot + encode + pace, overlapped with decode and inference threads."""
+    cap = await asyncio.to_thread(open_capture, source)
+    if cap is None: return
 
     # Limit FPS to save CPU
     FPS_LIMIT = 30
     frame_duration = 1.0 / FPS_LIMIT
 
-    while cap.isOpened():
-        start_time = time.time()
+    batch_q = queue.Queue(maxsize=2)
+    results = ResultBridge(settings.stream_batch_size * 2)
+    stop = threading.Event()
+    threading.Thread(target=read_frames, args=(cap, source, batch_q, stop), daemon=True).start()
+    threading.Thread(target=infer_frames, args=(batch_q, results, stop, conf_threshold), daemon=True).start()
 
-        success, frame = cap.read()
-        if not success:
-            if "youtube" not in source and not str(source).isdigit():
-                cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
-                continue
-            else: break
+    try:
+        next_time = time.time()
+        while True:
+            frame_result = await results.get()
+            if frame_result is None:
+                break
+            buffer = await asyncio.to_thread(render_frame, frame_result)
 
-        results = model(frame, conf=conf_threshold)
-        annotated_frame = results[0].plot()
-        ret, buffer = cv2.imencode('.jpg', annotated_frame)
-        
-        elapsed = time.time() - start_time
-        if elapsed < frame_duration:
-            time.sleep(frame_duration - elapsed)
+            # Non-blocking pacing: the event loop keeps serving other requests meanwhile
+            next_time += frame_duration
+            delay = next_time - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                next_time = time.time()
 
-        yield (b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
-    
-    cap.release()
+            yield b''.join((FRAME_HEADER, buffer, FRAME_FOOTER))
+    finally:
+        # Client disconnected or source ended: unblock and retire both worker threads
+        stop.set()
 
 # --- 5. UI & ENDPOINTS ---
 
@@ -204,31 +660,44 @@ async def video_feed(conf: float = 0.4):
     )
 
 @app.post("/detect_image")
-async def get_image_with_boxes(file: UploadFile = File(...), conf: float = Query(0.25)):
-    contents = await file.read()
-    results = model(process_image(contents), conf=conf)
-    log_detection(file.filename, results)
-    res, im_jpg = cv2.imencode(".jpg", results[0].plot())
-    return StreamingResponse(io.BytesIO(im_jpg.tobytes()), media_type="image/jpeg")
+async def get_image_with_boxes(background_tasks: BackgroundTasks, file: UploadFile = File(...), conf: float = Query(0.25)):
+    img = await process_image_async(await read_upload(file))
+    if img is None:
+        raise HTTPException(status_code=400, detail="Could not decode image")
+    result = await batcher.submit(img, conf)
+    log_detection(file.filename, *detected_objects(result), background_tasks)
+    # Single-shot body: plain Response, no BytesIO copy or chunked streaming
+    return Response(content=encode_jpeg(result.plot()), media_type="image/jpeg")
 
 @app.post("/detect_json")
-async def get_object_counts(file: UploadFile = File(...), conf: float = Query(0.25)):
-    results = model(process_image(await file.read()), conf=conf)
-    log_detection(file.filename, results)
-    detected = [model.names[int(box.cls)] for box in results[0].boxes]
+async def get_object_counts(background_tasks: BackgroundTasks, file: UploadFile = File(...), conf: float = Query(0.25)):
+    # No pixels are returned here, so large JPEGs can be decoded at reduced resolution
+    flag = await asyncio.to_thread(reduced_decode_flag, file.file, settings.imgsz)
+    img = await process_image_async(await read_upload(file), flag)
+    if img is None:
+        raise HTTPException(status_code=400, detail="Could not decode image")
+    result = await batcher.submit(img, conf)
+    detected, confs = detected_objects(result)
+    log_detection(file.filename, detected, confs, background_tasks)
     return JSONResponse(content={"filename": file.filename, "objects": len(detected), "breakdown": dict(Counter(detected))})
 
 @app.get("/history")
 def get_history(limit: int = 50):
-    with sqlite3.connect(settings.db_path) as conn:
-        conn.row_factory = sqlite3.Row
-        return {"latest_detections": [dict(row) for row in conn.cursor().execute("SELECT * FROM logs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()]}
+    return {"latest_detections": [dict(row) for row in get_conn().execute("SELECT * FROM logs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()]}
 
 @app.delete("/history/clear")
 def clear_history():
-    with sqlite3.connect(settings.db_path) as conn: conn.cursor().execute("DELETE FROM logs").connection.commit()
+    with get_conn() as conn: conn.execute("DELETE FROM logs")
     return {"message": "Logs cleared"}
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    workers = worker_count()
+    # Tell each worker how many siblings share the CPU
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    # Multiple workers need an import string so each process loads its own model;
+    # "auto" picks uvloop/httptools whenever they are installed
+    uvicorn.run(
+        "main:app" if workers > 1 else app,
+        host="0.0.0.0", port=8000, workers=workers, loop="auto", http="auto"
+    )
\ No newline at end of file